@@ -1,11 +1,14 @@
 import os
+import re
+import json
+import time
 import asyncio
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Tuple
+from itertools import zip_longest
+from typing import List, Dict, Any, Optional, Tuple, Callable
 from zoneinfo import ZoneInfo  # TR saati için
 import gspread
 from google.oauth2.service_account import Credentials
-from gspread_formatting import format_cell_ranges, CellFormat, Color
 from msc_eta_scraper import get_eta_etd, init_browser
 
 # =========================
@@ -33,7 +36,13 @@ LOG_HEADERS = [
 ]
 
 DEFAULT_CONCURRENCY = int(os.environ.get("CONCURRENCY", "8"))
-PASTEL_RED = Color(red=0.972, green=0.843, blue=0.855)  # #F8D7DA
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "50"))
+CACHE_DIR = ".cache"
+PREV_MAP_CACHE = os.path.join(CACHE_DIR, "prev_map.json")
+PREV_MAP_MAX_AGE = int(os.environ.get("PREV_MAP_MAX_AGE", str(8 * 24 * 3600)))  # sn (haftalık cron + pay)
+PASTEL_RED = {"red": 0.972, "green": 0.843, "blue": 0.855}  # #F8D7DA
+_TR_TZ = ZoneInfo("Europe/Istanbul")
+_NONDIGITS = re.compile(r"\D+")
 
 
 # =========================
@@ -46,7 +55,17 @@ def canon_date_str(s: str) -> str:
     s = s.strip()
     if s.lower() == "bilinmiyor":
         return ""
-    return "".join(ch for ch in s if ch.isdigit())
+    return _NONDIGITS.sub("", s)
+
+
+def col_letter(n: int) -> str:
+    """1 tabanlı sütun numarasını A1 harfine çevirir: 1 → A, 26 → Z, 27 → AA"""
+    s = ""
+    n -= 1
+    while n >= 0:
+        s = chr(65 + n % 26) + s
+        n = n // 26 - 1
+    return s
 
 
 def open_sheet():
@@ -65,8 +84,7 @@ def ensure_worksheet(sh, title: str, headers: Optional[List[str]] = None):
     except gspread.WorksheetNotFound:
         ws = sh.add_worksheet(title=title, rows=2000, cols=20)
         if headers:
-            end_col = chr(ord('A') + len(headers) - 1)
-            ws.update([headers], range_name=f"A1:{end_col}1")
+            ws.update([headers], range_name=f"A1:{col_letter(len(headers))}1")
     return ws
 
 
@@ -97,104 +115,256 @@ def read_bl_list(sh) -> List[str]:
     return [v.strip() for v in col[1:] if v and v.strip()]
 
 
-def read_previous_map(ws_data) -> Dict[str, Dict[str, str]]:
-    """Data sayfasındaki önceki ETA/ETD değerlerini haritalar."""
-    rows = ws_data.get_all_values()
+def read_previous_map(sh) -> Dict[str, Dict[str, str]]:
+    """Data sayfasındaki önceki ETA/ETD değerlerini haritalar (yalnızca A, B ve D sütunları)."""
+    resp = sh.values_batch_get(ranges=[f"{SHEET_DATA}!A2:B", f"{SHEET_DATA}!D2:D"])
+    value_ranges = resp.get("valueRanges", [])
+    bl_eta = value_ranges[0].get("values", []) if len(value_ranges) > 0 else []
+    etd_col = value_ranges[1].get("values", []) if len(value_ranges) > 1 else []
+
     prev: Dict[str, Dict[str, str]] = {}
-    if not rows:
-        return prev
-    header = rows[0]
-    idx_bl = header.index("Konşimento") if "Konşimento" in header else 0
-    idx_eta = header.index("ETA (Date)") if "ETA (Date)" in header else 1
-    idx_etd = header.index("ETD") if "ETD" in header else 3
-    for r in rows[1:]:
-        if not r or len(r) <= idx_bl:
-            continue
-        bl = (r[idx_bl] or "").strip()
+    for r, d in zip_longest(bl_eta, etd_col, fillvalue=[]):
+        bl = (r[0] if r else "").strip()
         if not bl:
             continue
-        eta_old = r[idx_eta] if len(r) > idx_eta else ""
-        etd_old = r[idx_etd] if len(r) > idx_etd else ""
+        eta_old = r[1] if len(r) > 1 else ""
+        etd_old = d[0] if d else ""
         prev[bl] = {"ETA": eta_old, "ETD": etd_old}
     return prev
 
 
-def write_results(ws_data, rows: List[List[Any]]):
-    """Data sayfasına başlık + verileri tamamen üzerine yazar (parça parça)."""
-    ws_data.clear()
-    end_col = chr(ord('A') + len(DATA_HEADERS) - 1)
-    ws_data.update([DATA_HEADERS], range_name=f"A1:{end_col}1")
-
-    if not rows:
-        return
-
-    # 🔹 Google API limitine takılmamak için 20'şerlik batchlerle yaz
-    batch_size = 20
-    for i in range(0, len(rows), batch_size):
-        chunk = rows[i:i + batch_size]
-        start_row = i + 2
-        end_row = start_row + len(chunk) - 1
-        ws_data.update(chunk, range_name=f"A{start_row}:{end_col}{end_row}")
-
-
-def append_logs(ws_log, log_rows: List[List[Any]]):
-    """Log sayfasına satır ekler; yoksa başlık yazar."""
-    existing = ws_log.get_all_values()
-    if not existing:
-        end_col = chr(ord('A') + len(LOG_HEADERS) - 1)
-        ws_log.update([LOG_HEADERS], range_name=f"A1:{end_col}1")
-    if log_rows:
-        ws_log.append_rows(log_rows, value_input_option="RAW")
+def load_prev_map_cache(sheet_id: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """Önceki çalıştırmanın yazdığı ETA/ETD haritasını diskten okur; yoksa/eskiyse None."""
+    try:
+        with open(PREV_MAP_CACHE, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("sheet_id") != sheet_id:
+        return None
+    if time.time() - cached.get("ts", 0) > PREV_MAP_MAX_AGE:
+        return None
+    return cached.get("map")
+
+
+def invalidate_prev_map_cache():
+    """Sheet yazımı başlamadan önceki haritayı siler; yarım kalan çalıştırma sonrası Sheets'ten okunur."""
+    try:
+        os.remove(PREV_MAP_CACHE)
+    except FileNotFoundError:
+        pass
 
 
-def apply_eta_change_format(ws_data, changed_rows_indices: List[int]):
-    """ETA değişen satırların B sütununu pastel kırmızıya boya."""
-    if not changed_rows_indices:
-        return
-    ranges = [(f"B{r}:B{r}", CellFormat(backgroundColor=PASTEL_RED)) for r in changed_rows_indices]
-    format_cell_ranges(ws_data, ranges)
+def save_prev_map_cache(sheet_id: str, rows: List[List[Any]]):
+    """Data'ya yazılan ETA/ETD değerlerini bir sonraki çalıştırma için diske yazar (atomik)."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    payload = {
+        "sheet_id": sheet_id,
+        "ts": time.time(),
+        "map": {r[0]: {"ETA": r[1], "ETD": r[3]} for r in rows if r[0]},
+    }
+    tmp = PREV_MAP_CACHE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp, PREV_MAP_CACHE)
+
+
+def _row_data(values: List[Any]) -> Dict[str, Any]:
+    """Bir satırı Sheets API v4 RowData yapısına çevirir (RAW metin)."""
+    return {"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in values]}
+
+
+def _coalesce_rows(indices: List[int]) -> List[Tuple[int, int]]:
+    """Ardışık satır numaralarını (başlangıç, bitiş) aralıklarına birleştirir: [3,4,5,8] → [(3,5),(8,8)]"""
+    spans: List[Tuple[int, int]] = []
+    for r in sorted(set(indices)):
+        if spans and r == spans[-1][1] + 1:
+            spans[-1] = (spans[-1][0], r)
+        else:
+            spans.append((r, r))
+    return spans
+
+
+def data_frame_requests(ws_data, total_rows: int) -> List[Dict[str, Any]]:
+    """Data başlığını yazar; `total_rows` veri satırının altında önceki çalıştırmadan kalanları temizler.
+
+    updateCells mevcut grid dışına yazamadığından, gerekirse önce satır eklenir.
+    """
+    requests: List[Dict[str, Any]] = []
+    if total_rows + 1 > ws_data.row_count:
+        requests.append({
+            "appendDimension": {
+                "sheetId": ws_data.id,
+                "dimension": "ROWS",
+                "length": total_rows + 1 - ws_data.row_count,
+            }
+        })
+    requests.append({
+        "updateCells": {
+            "range": {
+                "sheetId": ws_data.id,
+                "startRowIndex": 0,
+                "endRowIndex": 1,
+                "startColumnIndex": 0,
+                "endColumnIndex": len(DATA_HEADERS),
+            },
+            "rows": [_row_data(DATA_HEADERS)],
+            "fields": "userEnteredValue",
+        }
+    })
+    if total_rows + 1 < ws_data.row_count:
+        # rows verilmeyen updateCells aralıktaki değerleri siler
+        requests.append({
+            "updateCells": {
+                "range": {
+                    "sheetId": ws_data.id,
+                    "startRowIndex": total_rows + 1,
+                    "startColumnIndex": 0,
+                    "endColumnIndex": len(DATA_HEADERS),
+                },
+                "fields": "userEnteredValue",
+            }
+        })
+    return requests
+
+
+def data_row_requests(ws_data, row_numbers: List[int], rows: List[List[Any]]) -> List[Dict[str, Any]]:
+    """Satırları sheet'teki yerlerine yazar; ardışık satırlar tek updateCells'te birleşir."""
+    by_number = dict(zip(row_numbers, rows))
+    return [{
+        "updateCells": {
+            "start": {"sheetId": ws_data.id, "rowIndex": start - 1, "columnIndex": 0},
+            "rows": [_row_data(by_number[n]) for n in range(start, end + 1)],
+            "fields": "userEnteredValue",
+        }
+    } for start, end in _coalesce_rows(row_numbers)]
+
+
+def eta_change_format_requests(ws_data, changed_rows_indices: List[int]) -> List[Dict[str, Any]]:
+    """ETA değişen satırların B sütununu pastel kırmızıya boyayan repeatCell istekleri."""
+    return [{
+        "repeatCell": {
+            "range": {
+                "sheetId": ws_data.id,
+                "startRowIndex": start - 1,
+                "endRowIndex": end,
+                "startColumnIndex": 1,
+                "endColumnIndex": 2,
+            },
+            "cell": {"userEnteredFormat": {"backgroundColor": PASTEL_RED}},
+            "fields": "userEnteredFormat.backgroundColor",
+        }
+    } for start, end in _coalesce_rows(changed_rows_indices)]
+
+
+def log_requests(ws_log, log_rows: List[List[Any]], with_header: bool = False) -> List[Dict[str, Any]]:
+    """Log sayfasına satır ekleyen appendCells isteği; istenirse önce başlık eklenir."""
+    rows = [LOG_HEADERS] + list(log_rows) if with_header else log_rows
+    if not rows:
+        return []
+    return [{
+        "appendCells": {
+            "sheetId": ws_log.id,
+            "rows": [_row_data(r) for r in rows],
+            "fields": "userEnteredValue",
+        }
+    }]
 
 
 # =========================
 # Asenkron iş akışı
 # =========================
-async def run_once(bl_list: List[str]) -> List[Dict[str, Any]]:
-    results: List[Dict[str, Any]] = []
-    browser, pw = await init_browser()
+def failed_result(bl: str, msg: str) -> Dict[str, Any]:
+    """Çekilemeyen BL için get_eta_etd biçiminde 'Bilinmiyor' sonucu."""
+    return {
+        "konşimento": bl,
+        "ETA (Date)": "Bilinmiyor",
+        "Kaynak": "Bilinmiyor",
+        "ETD": "Bilinmiyor",
+        "log": [msg],
+    }
+
+
+async def run_once(
+    bl_list: List[str],
+    on_batch: Callable[[List[Tuple[int, Dict[str, Any]]]], None],
+):
+    """BL'leri eşzamanlı çeker; biten sonuçları WRITE_BATCH_SIZE'lık gruplar halinde
+    `on_batch`'e verir (ayrı thread'de), böylece Sheets yazımı kalan çekimlerle örtüşür.
+    Yazım hata verirse kalan çekimler iptal edilir ve hata yukarı iletilir."""
+    try:
+        browser, pw, client, refresh = await init_browser()
+    except Exception as e:
+        # Oturum hiç alınamadı: her BL "Bilinmiyor" + log satırı olarak yazılsın
+        print(f"⚠️ MSC oturumu başlatılamadı: {e}")
+        failed = [(i, failed_result(bl, f"oturum hatası: {e}")) for i, bl in enumerate(bl_list)]
+        await asyncio.to_thread(on_batch, failed)
+        return
 
     try:
         sem = asyncio.Semaphore(DEFAULT_CONCURRENCY)
+        queue: asyncio.Queue = asyncio.Queue()
 
-        async def task(bl: str):
+        async def task(i: int, bl: str):
             try:
-                return await get_eta_etd(bl, browser, sem)
+                return i, await get_eta_etd(bl, client, sem, refresh)
             except Exception as e:
                 print(f"[{bl}] ⚠️ Hata (üst seviye): {e}")
-                return {
-                    "konşimento": bl,
-                    "ETA (Date)": "Bilinmiyor",
-                    "Kaynak": "Bilinmiyor",
-                    "ETD": "Bilinmiyor",
-                    "log": [f"üst seviye hata: {e}"],
-                }
-
-        results = await asyncio.gather(*[task(bl) for bl in bl_list])
+                return i, failed_result(bl, f"üst seviye hata: {e}")
+
+        async def writer():
+            batch: List[Tuple[int, Dict[str, Any]]] = []
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH_SIZE:
+                    await asyncio.to_thread(on_batch, batch)
+                    batch = []
+            if batch:
+                await asyncio.to_thread(on_batch, batch)
+
+        scrapes = [asyncio.create_task(task(i, bl)) for i, bl in enumerate(bl_list)]
+        writer_task = asyncio.create_task(writer())
+        try:
+            pending = set(scrapes)
+            while pending:
+                done, pending = await asyncio.wait(pending | {writer_task}, return_when=asyncio.FIRST_COMPLETED)
+                if writer_task in done:
+                    writer_task.result()  # yazım hatasını hemen yükselt
+                    raise RuntimeError("Sheets yazıcısı beklenmedik şekilde durdu.")
+                pending.discard(writer_task)
+                for t in done:
+                    queue.put_nowait(t.result())
+            await queue.put(None)
+            await writer_task
+        finally:
+            # Hata durumunda kalan çekimleri ve yazıcıyı durdur
+            leftovers = [t for t in scrapes + [writer_task] if not t.done()]
+            for t in leftovers:
+                t.cancel()
+            await asyncio.gather(*leftovers, return_exceptions=True)
 
     finally:
+        await client.aclose()
         await browser.close()
         await pw.stop()
 
-    return results
 
-
-def to_rows_and_changes(results: List[Dict[str, Any]], prev_map: Dict[str, Dict[str, str]]) -> Tuple[List[List[Any]], List[int], List[List[Any]]]:
-    """Sonuçları tablo satırlarına dönüştürür."""
-    now_tr = datetime.now(ZoneInfo("Europe/Istanbul")).strftime("%Y-%m-%d %H:%M:%S")
-    rows: List[List[Any]] = []
+def to_rows_and_changes(
+    results: List[Dict[str, Any]],
+    prev_map: Dict[str, Dict[str, str]],
+    row_numbers: List[int],
+) -> Tuple[List[List[Any]], List[int], List[List[Any]]]:
+    """Sonuçları tablo satırlarına dönüştürür; `row_numbers` her sonucun sheet satır numarasıdır."""
+    now_tr = datetime.now(_TR_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    rows: List[List[Any]] = [None] * len(results)
     changed_row_numbers: List[int] = []
-    log_rows: List[List[Any]] = []
+    log_rows: List[List[Any]] = [None] * sum(len(r.get("log") or []) for r in results)
+    log_i = 0
 
-    for i, r in enumerate(results, start=2):  # sheet row index
+    for k, (i, r) in enumerate(zip(row_numbers, results)):  # i: sheet row index
         bl = (r.get("konşimento") or "").strip()
         eta_new = (r.get("ETA (Date)") or "").strip()
         etd_new = (r.get("ETD") or "").strip()
@@ -212,21 +382,54 @@ def to_rows_and_changes(results: List[Dict[str, Any]], prev_map: Dict[str, Dict[
                 note = f"Tarih bilginiz değişti: (yok) → {eta_new}"
             changed_row_numbers.append(i)
 
-        rows.append([
+        rows[k] = [
             bl,
             eta_new,
             kaynak,
             etd_new,
             now_tr,
             note,
-        ])
+        ]
 
         for msg in (r.get("log") or []):
-            log_rows.append([now_tr, bl, msg])
+            log_rows[log_i] = [now_tr, bl, msg]
+            log_i += 1
 
     return rows, changed_row_numbers, log_rows
 
 
+def make_batch_writer(sh, ws_data, ws_log, prev_map: Dict[str, Dict[str, str]], total: int):
+    """run_once için batch yazıcı: her grup tek spreadsheets.batchUpdate ile yazılır.
+
+    İlk grup Data başlığını/eski satır temizliğini ve gerekiyorsa Log başlığını da taşır.
+    Yazılan satırlar (sheet sırasıyla) ikinci dönüş değerinde birikir.
+    """
+    written: List[List[Any]] = [None] * total
+    state = {"first": True, "log_header": not ws_log.row_values(1)}
+
+    def write_batch(batch: List[Tuple[int, Dict[str, Any]]]):
+        row_numbers = [i + 2 for i, _ in batch]
+        rows, changed_row_numbers, log_rows = to_rows_and_changes([r for _, r in batch], prev_map, row_numbers)
+
+        requests: List[Dict[str, Any]] = []
+        if state["first"]:
+            requests += data_frame_requests(ws_data, total)
+        requests += (
+            data_row_requests(ws_data, row_numbers, rows)
+            + eta_change_format_requests(ws_data, changed_row_numbers)
+            + log_requests(ws_log, log_rows, with_header=state["log_header"])
+        )
+        sh.batch_update({"requests": requests})
+
+        state["first"] = False
+        state["log_header"] = False
+        for n, row in zip(row_numbers, rows):
+            written[n - 2] = row
+        print(f"📝 {len(rows)} satır yazıldı.")
+
+    return write_batch, written
+
+
 def main():
     print(f"📄 Spreadsheet ID: {os.environ.get(SHEET_ID_ENV, '<yok>')}")
     sh = open_sheet()
@@ -235,29 +438,24 @@ def main():
     ws_data = ensure_worksheet(sh, SHEET_DATA, headers=DATA_HEADERS)
     ws_log = ensure_worksheet(sh, SHEET_LOG, headers=LOG_HEADERS)
 
-    # Önceki değerler
-    prev_map = read_previous_map(ws_data)
+    # Önceki değerler (yerel önbellek yoksa/eskiyse Sheets'ten)
+    prev_map = load_prev_map_cache(sh.id)
+    if prev_map is None:
+        prev_map = read_previous_map(sh)
 
     # BL listesi
-    bl_list = read_bl_list(sh)
+    bl_list = list(dict.fromkeys(read_bl_list(sh)))  # tekrar edenleri at, sırayı koru
     if not bl_list:
         print("⚠️ BL listesi boş. Çıkılıyor.")
         return
 
     print(f"🔢 {len(bl_list)} konşimento bulundu. İşleniyor…")
 
-    # Asenkron çekim
-    results = asyncio.run(run_once(bl_list))
-
-    # Satırlar + değişim + loglar
-    rows, changed_row_numbers, log_rows = to_rows_and_changes(results, prev_map)
-
-    # Data'yı yaz ve boyama uygula
-    write_results(ws_data, rows)
-    apply_eta_change_format(ws_data, changed_row_numbers)
-
-    # Log'u ekle
-    append_logs(ws_log, log_rows)
+    # Asenkron çekim + akış halinde yazım (her grup tek spreadsheets.batchUpdate)
+    write_batch, written_rows = make_batch_writer(sh, ws_data, ws_log, prev_map, len(bl_list))
+    invalidate_prev_map_cache()
+    asyncio.run(run_once(bl_list, write_batch))
+    save_prev_map_cache(sh.id, written_rows)
 
     print("✅ Tamamlandı.")
 
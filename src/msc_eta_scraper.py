@@ -1,13 +1,18 @@
-import base64
+import functools
 import unicodedata
-import requests
 import re
 import os
+import time
 import asyncio
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+import diskcache
+import httpx
+import orjson
 from playwright.async_api import async_playwright
 
 # ---- eşleştirme yardımcıları ----
+_NORM_RE = re.compile(r"[^a-z0-9]+")
+
 def normalize(s: str) -> str:
     """Diacritics removal + lowercase."""
     if not s:
@@ -15,26 +20,146 @@ def normalize(s: str) -> str:
     nfkd = unicodedata.normalize("NFKD", s)
     return "".join(c for c in nfkd if unicodedata.category(c) != "Mn").lower()
 
+@functools.lru_cache(maxsize=4096)
 def _norm_desc(s: str) -> str:
     """Lower + diacritics kaldır + harf/rakam dışını tek boşluğa indir."""
     s = normalize(s or "")
-    s = re.sub(r"[^a-z0-9]+", " ", s).strip()
+    s = _NORM_RE.sub(" ", s).strip()
     return s
 
-POD_ETA_ALIASES = {
+POD_ETA_ALIASES = frozenset({
     "pod eta", "pod eta date", "eta pod",
     "pod estimated time of arrival", "pod estimated arrival",
     "pod eta at pod"
-}
+})
 
-IMPORT_TO_CONSIGNEE_ALIASES = {
+IMPORT_TO_CONSIGNEE_ALIASES = frozenset({
     "import to consignee", "import to consignee date", "import consignee"
-}
+})
 
 DEBUG_EVENTS = os.environ.get("DEBUG_EVENTS", "0") == "1"
 
+TRACK_URL = "https://www.msc.com/en/track-a-shipment"
+API_URL = "https://www.msc.com/api/feature/tools/TrackingInfo"
+BLOCKED_MEDIA = "**/*.{png,jpg,jpeg,svg,css,woff,woff2,mp4,webm,gif,ico}"
+# Glob'ta `*` "/" ile eşleşmez; host/yol neresinde geçerse geçsin yakalamak için regex (route search() ile eşler)
+BLOCKED_TRACKERS = re.compile(r"google-analytics|googletagmanager|doubleclick|hotjar|facebook")
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+API_HEADERS = {
+    "Accept": "application/json, text/plain, */*",
+    "Content-Type": "application/json",
+    "Origin": "https://www.msc.com",
+    "Referer": TRACK_URL,
+    "User-Agent": USER_AGENT,
+    "X-Requested-With": "XMLHttpRequest",
+}
+
+_SESSION_LOCK = asyncio.Lock()
+SESSION_BOOTSTRAP_ATTEMPTS = 3
+
+MSC_RPS = float(os.environ.get("MSC_RPS", "5"))
+MAX_429_RETRIES = 4
+
+# ---- hız sınırlayıcı ----
+class RateLimiter:
+    """Token-bucket: tüm görevler arasında saniyede en fazla `requests_per_second` istek."""
+
+    def __init__(self, requests_per_second: float, burst: Optional[int] = None):
+        self.rate = requests_per_second
+        self.capacity = burst or max(1, int(requests_per_second))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+rate_limiter = RateLimiter(requests_per_second=MSC_RPS)
+
+# ---- sonuç önbelleği (BL + saat dilimi) ----
+ETA_CACHE_DIR = os.path.join(".cache", "msc_eta")
+ETA_CACHE_TTL = 3600  # sn
+
+@functools.lru_cache(maxsize=1)
+def _eta_cache() -> diskcache.Cache:
+    return diskcache.Cache(ETA_CACHE_DIR)
+
+
+def cached_by_hour(fn):
+    """Aynı saat dilimindeki tekrar çekimleri diskten döndürür (semafor beklenmez)."""
+    @functools.wraps(fn)
+    async def wrapper(bl: str, *args, **kwargs):
+        key = (bl, int(time.time() // ETA_CACHE_TTL))
+        hit = _eta_cache().get(key)
+        if hit is not None:
+            print(f"[{bl}] → ETA: {hit['ETA (Date)']} ({hit['Kaynak']}), ETD: {hit['ETD']} (önbellek)")
+            return {**hit, "log": []}
+        result = await fn(bl, *args, **kwargs)
+        # Başarısız çekimleri önbelleğe alma; bir sonraki çalıştırma tekrar denesin.
+        # Loglar o çekime ait olduğundan saklanmaz (tekrar Log'a düşmesin).
+        if result.get("ETA (Date)") != "Bilinmiyor":
+            _eta_cache().set(key, {k: v for k, v in result.items() if k != "log"}, expire=ETA_CACHE_TTL)
+        return result
+    return wrapper
+
+
+# ---- oturum (cookie + token) ----
+async def fetch_session(context) -> Dict[str, str]:
+    """Takip sayfasını bir kez açıp cookie + __RequestVerificationToken toplar."""
+    page = await context.new_page()
+    page.set_default_navigation_timeout(120000)
+    page.set_default_timeout(15000)
+
+    try:
+        await page.goto(TRACK_URL, wait_until="domcontentloaded")
+        cookies = await page.context.cookies()
+        cookie_str = "; ".join(f"{c['name']}={c['value']}" for c in cookies)
+        token = await page.evaluate("() => document.querySelector('input[name=__RequestVerificationToken]')?.value")
+    finally:
+        await page.close()
+    if not token:
+        raise RuntimeError("__RequestVerificationToken bulunamadı.")
+    return {"cookie": cookie_str, "token": token}
+
+
+async def bootstrap_session(context) -> Dict[str, str]:
+    """fetch_session'ı geçici hatalara karşı SESSION_BOOTSTRAP_ATTEMPTS kez dener."""
+    for attempt in range(1, SESSION_BOOTSTRAP_ATTEMPTS + 1):
+        try:
+            return await fetch_session(context)
+        except Exception as e:
+            if attempt == SESSION_BOOTSTRAP_ATTEMPTS:
+                raise
+            print(f"⚠️ Oturum alınamadı ({attempt}. deneme): {e}")
+            await asyncio.sleep(2 ** attempt)
+
+
+def _session_headers(session: Dict[str, str]) -> Dict[str, str]:
+    return {
+        "Cookie": session.get("cookie", ""),
+        "__RequestVerificationToken": session.get("token", ""),
+    }
+
+
+async def refresh_session(context, client: httpx.AsyncClient, stale_token: str):
+    """401/403 sonrası oturumu yenileyip client başlıklarına yazar; eşzamanlı görevler aynı yenilemeyi paylaşır."""
+    async with _SESSION_LOCK:
+        if client.headers.get("__RequestVerificationToken", "") == stale_token:
+            client.headers.update(_session_headers(await fetch_session(context)))
+
+
 # ---- ana fonksiyonlar ----
-async def get_eta_etd(bl: str, browser, sem):
+@cached_by_hour
+async def get_eta_etd(bl: str, client: httpx.AsyncClient, sem, refresh: Optional[Callable[[str], Awaitable[None]]] = None):
     """
     Döndürür:
       {
@@ -46,52 +171,36 @@ async def get_eta_etd(bl: str, browser, sem):
       }
     """
     async with sem:
-        page = await browser.new_page()
-        page.set_default_navigation_timeout(120000)
-        page.set_default_timeout(15000)
-
-        # Gereksiz medya isteklerini iptal et
-        await page.route("**/*.{png,jpg,jpeg,svg,css,woff,woff2,mp4,webm}", lambda r: r.abort())
-
         eta = "Bilinmiyor"
         kaynak = "Bilinmiyor"
         etd = "Bilinmiyor"
         logs: List[str] = []
 
         try:
-            # 1️⃣ Sayfaya git
-            param = f"trackingNumber={bl}&trackingMode=0"
-            b64 = base64.b64encode(param.encode()).decode()
-            url = f"https://www.msc.com/en/track-a-shipment?params={b64}"
-            await page.goto(url, wait_until="domcontentloaded")
-
-            # 2️⃣ Cookie + token al
-            cookies = await page.context.cookies()
-            cookie_str = "; ".join([f"{c['name']}={c['value']}" for c in cookies])
-            token = await page.evaluate("() => document.querySelector('input[name=__RequestVerificationToken]')?.value")
-            await page.close()
-
-            # 3️⃣ Pagination döngüsü
-            api_url = "https://www.msc.com/api/feature/tools/TrackingInfo"
+            # Pagination döngüsü (oturum başlıkları paylaşılan client'ta)
             payload = {"trackingNumber": bl, "trackingMode": "0"}
-            headers = {
-                "Accept": "application/json, text/plain, */*",
-                "Content-Type": "application/json",
-                "Cookie": cookie_str,
-                "Origin": "https://www.msc.com",
-                "Referer": url,
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
-                "X-Requested-With": "XMLHttpRequest",
-                "__RequestVerificationToken": token,
-            }
 
             all_containers = []
             page_number = 1
+            refreshed = False
+            attempt = 0
             while True:
                 payload["pageNumber"] = page_number
-                resp = requests.post(api_url, json=payload, headers=headers, timeout=30)
+                used_token = client.headers.get("__RequestVerificationToken", "")
+                await rate_limiter.acquire()
+                resp = await client.post(API_URL, json=payload)
+                if resp.status_code == 429 and attempt < MAX_429_RETRIES:
+                    # Hız limitine takıldık: üstel bekleme ile aynı sayfayı tekrar dene
+                    await asyncio.sleep(2 ** attempt)
+                    attempt += 1
+                    continue
+                if resp.status_code in (401, 403) and refresh and not refreshed:
+                    # Oturum düşmüş: token'ı yenile, aynı sayfayı bir kez daha dene
+                    refreshed = True
+                    await refresh(used_token)
+                    continue
                 resp.raise_for_status()
-                data = resp.json()
+                data = orjson.loads(resp.content)
 
                 bills = (data or {}).get("Data", {}).get("BillOfLadings", [])
                 if not bills:
@@ -108,33 +217,36 @@ async def get_eta_etd(bl: str, browser, sem):
                 if not next_page or next_page == page_number:
                     break
                 page_number += 1
-                await asyncio.sleep(1.0)
+                attempt = 0
 
             if not all_containers:
                 logs.append("Hiç konteyner verisi alınamadı (tüm sayfalar tarandı).")
                 raise ValueError("ContainersInfo boş.")
 
+            # --- Tek geçiş: ETD (son), POD ETA (ilk), Import to consignee (ilk) ---
+            etd_last = None
+            pod_eta = None
+            import_eta = None
+            for c in all_containers:
+                for ev in (c.get("Events") or []):
+                    desc = _norm_desc(ev.get("Description"))
+                    date = ev.get("Date")
+                    if desc == "export loaded on vessel":
+                        etd_last = date
+                    elif desc in POD_ETA_ALIASES and pod_eta is None:
+                        pod_eta = date
+                    elif desc in IMPORT_TO_CONSIGNEE_ALIASES and import_eta is None:
+                        import_eta = date
+
             # --- ETD (Export Loaded on Vessel) ---
-            export_events = [
-                (ev or {}).get("Date")
-                for c in all_containers
-                for ev in (c.get("Events") or [])
-                if _norm_desc(ev.get("Description")) == "export loaded on vessel"
-            ]
-            if export_events:
-                etd = export_events[-1]
+            if etd_last is not None:
+                etd = etd_last
             else:
                 logs.append("ETD için 'export loaded on vessel' event'i bulunamadı.")
 
             # --- ETA ---
-            event_etas = []
-            for c in all_containers:
-                for ev in (c.get("Events") or []):
-                    if _norm_desc(ev.get("Description")) in POD_ETA_ALIASES:
-                        event_etas.append(ev.get("Date"))
-
-            if event_etas:
-                eta, kaynak = event_etas[0], "POD ETA"
+            if pod_eta is not None:
+                eta, kaynak = pod_eta, "POD ETA"
             else:
                 general = bills[0].get("GeneralTrackingInfo", {}) if bills else {}
                 if general.get("FinalPodEtaDate"):
@@ -143,16 +255,10 @@ async def get_eta_etd(bl: str, browser, sem):
                     container_etas = [c.get("PodEtaDate") for c in all_containers if c.get("PodEtaDate")]
                     if container_etas:
                         eta, kaynak = container_etas[0], "Container POD ETA"
+                    elif import_eta is not None:
+                        eta, kaynak = import_eta, "Import to consignee"
                     else:
-                        import_events = []
-                        for c in all_containers:
-                            for ev in (c.get("Events") or []):
-                                if _norm_desc(ev.get("Description")) in IMPORT_TO_CONSIGNEE_ALIASES:
-                                    import_events.append(ev.get("Date"))
-                        if import_events:
-                            eta, kaynak = import_events[0], "Import to consignee"
-                        else:
-                            logs.append("ETA için uygun event/alan bulunamadı.")
+                        logs.append("ETA için uygun event/alan bulunamadı.")
 
             if DEBUG_EVENTS:
                 try:
@@ -180,5 +286,28 @@ async def get_eta_etd(bl: str, browser, sem):
 
 async def init_browser():
     pw = await async_playwright().start()
-    browser = await pw.chromium.launch(headless=True)
-    return browser, pw
+    browser = None
+    try:
+        browser = await pw.chromium.launch(headless=True)
+        context = await browser.new_context()
+
+        # Gereksiz medya + analitik/reklam isteklerini context seviyesinde bir kez iptal et
+        await context.route(BLOCKED_MEDIA, lambda r: r.abort())
+        await context.route(BLOCKED_TRACKERS, lambda r: r.abort())
+
+        # Tek client: HTTP/2 + bağlantı havuzu tüm BL'ler arasında paylaşılır
+        session = await bootstrap_session(context)
+        client = httpx.AsyncClient(
+            http2=True,
+            timeout=30,
+            headers={**API_HEADERS, **_session_headers(session)},
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        )
+    except Exception:
+        # Oturum alınamadıysa Chromium + Playwright sürücüsünü sızdırma
+        if browser is not None:
+            await browser.close()
+        await pw.stop()
+        raise
+    refresh = functools.partial(refresh_session, context, client)
+    return browser, pw, client, refresh